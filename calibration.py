@@ -0,0 +1,274 @@
+import os
+import sys
+import argparse
+
+import cv2
+import numpy as np
+
+import config
+import geometry
+import processing
+
+# Solves the rig constants from the frames of `cam.py calibrate` (X=0,
+# rotated from 0 to 180 degrees). At X=0 every frame shows the rotation
+# axis at the same image position -s0, where s0 is the offset of the sensor
+# center from the axis. Derotating frame k about the image center leaves it
+# shifted against frame k-1 by (R_k - R_k-1) s0, so the shifts measured by
+# phase correlation between consecutive frames give s0 by least squares.
+
+SENSOR_SIZE             = [3.6, 2.7] # mm, same as SCANCAM_SENSOR_SIZE in cam.py
+SOLVE_WIDTH             = 512        # px, frames are registered at this width
+
+LOG_POLAR_SIZE          = [256, 360] # log radius bins, angle bins
+
+
+def get_calibration_files(input_dir):
+
+    # naming convention
+    # "calibrate_{:06.2f}_{:05}_{:06.3f}_{:06.3f}{}".format(
+    #     SCANCAM_ENDSTOP_DIST, i, pos[0], pos[1], FILE_EXTENSION)
+
+    found = []
+
+    for f in sorted(os.listdir(input_dir)):
+        if not f.startswith("calibrate_") or not f.lower().endswith(processing.FILE_EXTENSION):
+            continue
+
+        fields = os.path.splitext(f)[0].split("_")
+        found.append([os.path.join(input_dir, f), float(fields[1]), float(fields[3]), float(fields[4])])
+
+    return found
+
+
+def get_runs(calibration_files):
+
+    # frames of different calibration runs (e.g. before and after --write)
+    # differ in the endstop distance of their file names. Returns
+    # {endstop_dist: files}, newest run (by file mtime) first
+
+    runs = {}
+
+    for f in calibration_files:
+        runs.setdefault(f[1], []).append(f)
+
+    newest = lambda e: max(os.path.getmtime(f[0]) for f in runs[e])
+
+    return {e: runs[e] for e in sorted(runs.keys(), key=newest, reverse=True)}
+
+
+def load_frames(paths, width=SOLVE_WIDTH):
+
+    # grayscale stack (N, h, w), flipped the same way processing.py flips tiles
+
+    frames = []
+
+    for path in paths:
+        img = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_4)
+
+        if img is None:
+            raise Exception("could not decode image: {}".format(path))
+
+        img = processing.flip_tile(img, processing.FLIP_HORIZONTAL, processing.FLIP_VERTICAL)
+
+        height = int(round(img.shape[0] * width / img.shape[1]))
+        frames.append(cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA))
+
+    return np.array(frames, dtype=np.float32)
+
+
+def _window(shape):
+
+    # radial hann window, hides image borders and corners emptied by derotation
+
+    h, w = shape
+    y, x = np.ogrid[0:h, 0:w]
+    r = np.sqrt(((x - (w-1)/2) / (w/2))**2 + ((y - (h-1)/2) / (h/2))**2)
+
+    return np.where(r < 1, 0.5 + 0.5 * np.cos(np.pi * np.minimum(r, 1)), 0).astype(np.float32)
+
+
+def phase_correlate(a, b):
+
+    # batched phase correlation of (N, h, w) stacks, returns (N, 2) shifts [dx, dy]
+    # with b(u) ~ a(u - d), subpixel by parabolic fit around the peak
+
+    fa = np.fft.fft2(a)
+    fb = np.fft.fft2(b)
+
+    cross = np.conj(fa) * fb
+    cross /= np.abs(cross) + 1e-9
+
+    corr = np.real(np.fft.ifft2(cross))
+
+    n, h, w = corr.shape
+    peak = corr.reshape(n, -1).argmax(axis=1)
+    py, px = np.unravel_index(peak, (h, w))
+    rows = np.arange(n)
+
+    def subpixel(c_minus, c_center, c_plus):
+        den = c_minus - 2 * c_center + c_plus
+        return np.where(np.abs(den) > 1e-12, 0.5 * (c_minus - c_plus) / np.where(den == 0, 1, den), 0)
+
+    dx = px + subpixel(corr[rows, py, (px-1) % w], corr[rows, py, px], corr[rows, py, (px+1) % w])
+    dy = py + subpixel(corr[rows, (py-1) % h, px], corr[rows, py, px], corr[rows, (py+1) % h, px])
+
+    # wrap to [-size/2, size/2)
+    dx = (dx + w/2) % w - w/2
+    dy = (dy + h/2) % h - h/2
+
+    return np.stack([dx, dy], axis=-1)
+
+
+def estimate_rotations(frames):
+
+    # rotation between consecutive frames from the log-polar transform of the
+    # magnitude spectrum (translation invariant), in degrees, modulo 180
+
+    # square center crop, the DFT grid of a non-square frame is anisotropic
+    h, w = frames.shape[1:]
+    size = min(h, w)
+    frames = frames[:, (h-size)//2:(h-size)//2+size, (w-size)//2:(w-size)//2+size]
+    h, w = size, size
+
+    window = _window(frames.shape[1:])
+    spectra = np.abs(np.fft.fftshift(np.fft.fft2(frames * window), axes=(-2, -1)))
+    spectra = np.log1p(spectra).astype(np.float32)
+
+    polar = np.array([cv2.warpPolar(
+        s, tuple(LOG_POLAR_SIZE), (w/2, h/2), min(h, w)/2,
+        cv2.WARP_POLAR_LOG + cv2.INTER_LINEAR) for s in spectra])
+
+    # ignore the lowest frequencies, dominated by the window and vignetting
+    polar = polar[:, :, LOG_POLAR_SIZE[0] // 8:]
+
+    shifts = phase_correlate(polar[:-1], polar[1:])
+
+    # a positive image rotation (geometry.rotate_points) shifts the spectrum
+    # towards smaller polar angles
+    angles = -shifts[:, 1] * 360 / LOG_POLAR_SIZE[1]
+
+    # magnitude spectra are point symmetric, wrap to [-90, 90)
+    return (angles + 90) % 180 - 90
+
+
+def derotate(frames, angles):
+
+    # rotate every frame by -angle about the image center, so that
+    # out(u) = frame(R(-angle) u), angles as in geometry.rotate_points
+
+    h, w = frames.shape[1:]
+    out = np.empty_like(frames)
+
+    for i in range(0, len(frames)):
+        m = cv2.getRotationMatrix2D(((w-1)/2, (h-1)/2), -angles[i], 1.0)
+        out[i] = cv2.warpAffine(frames[i], m, (w, h), flags=cv2.INTER_LINEAR)
+
+    return out
+
+
+def solve(frames, commanded):
+
+    # returns sensor offset s0 [px] in (flipped) image coordinates, the rotation
+    # direction of the image relative to the commanded angles and the residual
+    # of the measured against the commanded rotation steps
+
+    commanded = np.asarray(commanded, dtype=np.float64)
+    steps = np.diff(commanded)
+
+    measured = estimate_rotations(frames)
+
+    # images may turn with or against the commanded direction (flips, motor wiring)
+    direction = 1 if np.median(measured * steps) >= 0 else -1
+    rotation_residual = measured - direction * steps
+
+    angles = direction * commanded
+
+    derotated = derotate(frames, angles)
+    window = _window(frames.shape[1:])
+    shifts = phase_correlate(derotated[:-1] * window, derotated[1:] * window)
+
+    # shift between consecutive derotated frames: d_k = -(R_k - R_k-1) s0
+    rotations = geometry.rotate_points(
+        np.array([[1, 0], [0, 1]], dtype=np.float64), angles[:, np.newaxis])
+    rotations = np.transpose(rotations, (0, 2, 1)) # columns are rotated basis vectors
+
+    a = -(rotations[1:] - rotations[:-1]).reshape(-1, 2)
+    b = shifts.reshape(-1)
+
+    s0, residual, rank, sv = np.linalg.lstsq(a, b, rcond=None)
+
+    fit_error = np.sqrt(np.mean((a @ s0 - b)**2))
+
+    return s0, direction, rotation_residual, fit_error
+
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("input_dir", help="directory with calibrate_*.jpg frames")
+    ap.add_argument("--write", action="store_true", default=False, help="write corrected constants to {}".format(os.path.basename(config.CONFIG_FILE)))
+    ap.add_argument("--endstop", type=float, default=None, help="solve the run captured with this SCANCAM_ENDSTOP_DIST (default: newest run)")
+    args = vars(ap.parse_args())
+
+    runs = get_runs(get_calibration_files(args["input_dir"]))
+
+    if len(runs) == 0:
+        print("no calibration frames found in {}".format(args["input_dir"]))
+        sys.exit(-1)
+
+    if args["endstop"] is not None:
+        matching = [e for e in runs.keys() if abs(e - args["endstop"]) < 0.005]
+
+        if len(matching) == 0:
+            print("no calibration run with SCANCAM_ENDSTOP_DIST {:.2f}, found {}".format(
+                args["endstop"], ", ".join("{:.2f}".format(e) for e in runs.keys())))
+            sys.exit(-1)
+
+        calibration_files = runs[matching[0]]
+
+    else:
+        calibration_files = list(runs.values())[0]
+
+        if len(runs) > 1:
+            # solving mixed runs together fits a constant that matches neither
+            print("WARNING: frames of {} calibration runs ({}), solving only the newest one, choose another with --endstop".format(
+                len(runs), ", ".join("{:.2f}".format(e) for e in runs.keys())))
+            print("")
+
+    if len(calibration_files) < 3:
+        print("need at least 3 calibration frames, found {}".format(len(calibration_files)))
+        sys.exit(-1)
+
+    endstop_dist = calibration_files[0][1]
+    commanded = [f[3] for f in calibration_files]
+
+    frames = load_frames([f[0] for f in calibration_files])
+
+    s0, direction, rotation_residual, fit_error = solve(frames, commanded)
+
+    mm_per_px = SENSOR_SIZE[0] / frames.shape[2]
+
+    # image x is tangential, image y radial (see geometry.get_rotated_sensors)
+    tangential_offset = s0[0] * mm_per_px
+    radial_offset = s0[1] * mm_per_px
+
+    print("frames:                {} ({:.1f} to {:.1f} deg)".format(len(frames), commanded[0], commanded[-1]))
+    print("image rotation:        {} commanded direction".format("with" if direction > 0 else "against"))
+    print("rotation step error:   mean {:+.3f} deg, max {:.3f} deg".format(np.mean(rotation_residual), np.max(np.abs(rotation_residual))))
+    print("shift fit error:       {:.3f} px ({:.4f} mm)".format(fit_error, fit_error * mm_per_px))
+    print("radial offset:         {:+.4f} mm".format(radial_offset))
+    print("tangential offset:     {:+.4f} mm".format(tangential_offset))
+    print("")
+    print("SCANCAM_ENDSTOP_DIST = {:.2f} (captured with {:.2f})".format(endstop_dist + radial_offset, endstop_dist))
+    print("TANGENTIAL_OFFSET    = {:.4f}".format(tangential_offset))
+    print("DIAM_OFFSET          = {:.4f} (only for scans captured with SCANCAM_ENDSTOP_DIST {:.2f})".format(radial_offset, endstop_dist))
+
+    if args["write"]:
+        # the corrected endstop distance centers the sensor for all new scans,
+        # so processing needs no radial offset anymore
+        config.save({
+            "SCANCAM_ENDSTOP_DIST": round(endstop_dist + radial_offset, 3),
+            "DIAM_OFFSET": 0.0,
+            "TANGENTIAL_OFFSET": round(tangential_offset, 4)
+        })
+        print("written to {}".format(config.CONFIG_FILE))
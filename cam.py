@@ -3,19 +3,26 @@
 import logging
 import argparse
 from datetime import datetime
-import math
 import time
 import os
 import subprocess
 import shutil
 import re
 import sys
+import json
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from fractions import Fraction
 
+import numpy as np
 import serial
 import picamera
 
-SCANCAM_ENDSTOP_DIST    = 37.70
+import config
+import geometry
+import quality
+import transfer
+
+SCANCAM_ENDSTOP_DIST    = config.get("SCANCAM_ENDSTOP_DIST", 37.70) # see calibration.py
 SCANCAM_DIAMETER        = 60
 SCANCAM_SENSOR_SIZE     = [3.6, 2.7]
 
@@ -37,6 +44,10 @@ FEEDRATE_Y              = 500
 PRE_CAPTURE_WAIT        = 0.5
 POST_CAPTURE_WAIT       = 0.1
 
+# QUALITY CHECK
+QUALITY_MAX_RETAKES     = 2
+METADATA_FILE           = "metadata.jsonl"
+
 MODE_STILL              = "still"
 MODE_VIDEO              = "video"
 MODE_MOVE               = "move"        
@@ -174,52 +185,68 @@ def init_picamera():
     camera.awb_mode = "sunlight"
 
 
-def close_ports():
+def move_to(pos):
 
-    log.info("closing serial connections")
+    # separate movement commands for X and Y so we can have different feedrates
 
-    if not ser_grbl is None:
-        ser_grbl.close()
+    cmd = "G1 X{} F{}".format(pos[0], FEEDRATE_X)
+    _send_command(ser_grbl, cmd)
 
-    if not ser_trigger is None:
-        ser_trigger.close()
+    wait_for_idle()
 
-    if not camera is None:
-        camera.stop_preview()
-        camera.close()
+    cmd = "G1 Y{} F{}".format(pos[1], FEEDRATE_Y)
+    _send_command(ser_grbl, cmd)
+
+    wait_for_idle()
 
 
-def get_positions(diameter, sensor_size):
+def retake_until_ok(path, metrics):
 
-    # calculate min number of rings without gaps (ceil will introduce necessary overlap)
-    # ring0 is always at center, so subtract half a sensor size
-    num_rings = math.ceil((diameter-sensor_size[1])/2/sensor_size[1])
-    ring_offsets = [x * sensor_size[1] for x in range(0, num_rings)]
-    positions_per_ring = []
+    # carriage has to be at the position of path already
 
-    for i in range(0, len(ring_offsets)):
-        offset = ring_offsets[i]
+    retakes = 0
+    failures = quality.get_failures(metrics)
 
-        if offset == 0:
-            positions_per_ring.append([[0, 0]])
-            continue
+    while len(failures) > 0 and retakes < QUALITY_MAX_RETAKES:
+        log.warning("quality check failed for {} ({}), retaking".format(os.path.basename(path), ", ".join(failures)))
 
-        # when computing the circumference do not use the center of the sensor
-        # but the middle of the top border of the sensor (to avoid gaps)
-        circ = 2 * math.pi * (offset + sensor_size[1]/2)
-        num_stops = math.ceil(circ/sensor_size[0])
+        time.sleep(PRE_CAPTURE_WAIT)
+        camera.capture(path)
+        retakes += 1
 
-        stops = []
-        for j in range(0, num_stops):
-            stops.append([offset, (j/num_stops) * 360]) # degree
+        metrics = quality.get_metrics(path)
+        failures = quality.get_failures(metrics)
 
-        # traverse backwards in every second ring
-        if i % 2 == 0:
-            positions_per_ring.append(stops)
-        else:
-            positions_per_ring.append(list(reversed(stops)))
+    if len(failures) > 0:
+        log.error("keeping {} despite failed quality check ({})".format(os.path.basename(path), ", ".join(failures)))
+
+    return dict(metrics, retakes=retakes, failures=failures)
+
+
+def finish_tile(path, meta):
+
+    # tile is final: log it to the scan metadata and hand it to the streaming sender
+
+    with open(os.path.join(OUTPUT_DIRECTORY, METADATA_FILE), "a") as f:
+        f.write(json.dumps(dict(meta, name=os.path.basename(path))) + "\n")
 
-    return positions_per_ring
+    if sender is not None:
+        sender.publish(path, meta)
+
+
+def close_ports():
+
+    log.info("closing serial connections")
+
+    if not ser_grbl is None:
+        ser_grbl.close()
+
+    if not ser_trigger is None:
+        ser_trigger.close()
+
+    if not camera is None:
+        camera.stop_preview()
+        camera.close()
 
 
 log = logging.getLogger()
@@ -244,6 +271,7 @@ if __name__ == "__main__":
     ap.add_argument("-f", "--feedrate", type=int, default=FEEDRATE, help="movement speed [mm/min]")
     ap.add_argument("-d", "--delay", type=int, default=1, help="delay [s]")
     ap.add_argument("--no-camera", action="store_true", default=False, help="do not initialize picamera")
+    ap.add_argument("--stream", type=str, default=None, help="stream tiles to receiver at host[:port] during the scan")
     ap.add_argument("--debug", action="store_true", default=False, help="print debug messages")
     args = vars(ap.parse_args())
 
@@ -273,6 +301,7 @@ if __name__ == "__main__":
     camera = None
     ser_grbl = None
     ser_trigger = None
+    sender = None
 
     # sanity checks
 
@@ -379,23 +408,27 @@ if __name__ == "__main__":
 
         log.info("STILL MODE")
 
-        positions = get_positions(
+        positions, rings, stops = geometry.get_positions(
             SCANCAM_DIAMETER, 
             [SCANCAM_SENSOR_SIZE[0]-0.1, SCANCAM_SENSOR_SIZE[1]-0.1] # create a bit of overlap
         )
 
         # debug pattern
-        # positions = [[[0, 0]]]
-        # for i in range(1, 10):
-        #     positions.append([
-        #         [1*i, 0],        
-        #         [1*i, 90],
-        #         [1*i, 180],
-        #         [1*i, 270],
-        #     ])
-
-        total_pos = sum([len(x) for x in positions])
-        num_pos = 0
+        # positions = np.array([[0, 0]] + [[1*i, a] for i in range(1, 10) for a in [0, 90, 180, 270]])
+        # rings = np.array([0] + [i for i in range(1, 10) for a in range(4)])
+        # stops = np.array([0] + [a for i in range(1, 10) for a in range(4)])
+
+        if args["stream"] is not None:
+            host, _, port = args["stream"].partition(":")
+            sender = transfer.TileSender(host, port=int(port) if port else transfer.TRANSFER_PORT)
+            log.info("streaming tiles to {}".format(args["stream"]))
+
+        quality_worker = ThreadPoolExecutor(max_workers=1)
+        pending = []
+
+        total_pos = len(positions)
+        ring_sizes = np.bincount(rings)
+        num_rings = len(ring_sizes)
 
         # cmd = "G1 X{} Y{} F{}".format(0, 0, FEEDRATE_SLOW*2)
         # _send_command(ser_grbl, cmd)
@@ -403,51 +436,71 @@ if __name__ == "__main__":
         # close_ports()
         # sys.exit(0)
 
-        for i in range(0, len(positions)):
+        for n in range(0, total_pos):
 
-            ring = positions[i]
+            pos = positions[n].tolist()
+            i = int(rings[n])
+            j = int(stops[n])
+            num_pos = n + 1
 
-            for j in range(0, len(ring)):
+            log.info("POS {}/{} | R: {}/{} I:{}/{} ".format(
+                num_pos, total_pos, 
+                i, num_rings, 
+                j, ring_sizes[i]
+            ))
 
-                pos = ring[j]
-                num_pos += 1
+            move_to(pos)
 
-                log.info("POS {}/{} | R: {}/{} I:{}/{} ".format(
-                    num_pos, total_pos, 
-                    i, len(positions), 
-                    j, len(ring)
-                ))
+            log.debug("TRIGGER [{}/{}]".format(num_pos, total_pos))
 
-                # separate movement commands for X and Y so we can have different feedrates
+            time.sleep(PRE_CAPTURE_WAIT)
+
+            filename = [OUTPUT_DIRECTORY, "{:05}-{:05}-{:05}_{:06.3f}_{:06.3f}{}".format(
+                num_pos, i, j,
+                pos[0], pos[1],
+                FILE_EXTENSION
+            )]
+
+            if filename is None:
+                raise Exception("could not acquire filename")
 
-                cmd = "G1 X{} F{}".format(ring[j][0], FEEDRATE_X)
-                _send_command(ser_grbl, cmd)
+            camera.capture(os.path.join(*filename))
 
-                wait_for_idle()
+            log.debug("FILE: {}".format(filename[1]))
 
-                cmd = "G1 Y{} F{}".format(ring[j][1], FEEDRATE_Y)
-                _send_command(ser_grbl, cmd)
+            meta = {
+                "num_pos": num_pos, "total_pos": total_pos,
+                "ring": i, "stop": j,
+                "x": pos[0], "y": pos[1]
+            }
 
-                wait_for_idle()
+            # the quality check runs in the worker while we wait anyway, if it
+            # is done in time a failed capture is retaken right here, otherwise
+            # it is checked at the end of the ring
 
-                log.debug("TRIGGER [{}/{}]".format(num_pos, total_pos))
+            future = quality_worker.submit(quality.get_metrics, os.path.join(*filename))
 
-                time.sleep(PRE_CAPTURE_WAIT)
+            try:
+                metrics = future.result(timeout=POST_CAPTURE_WAIT)
+                metrics = retake_until_ok(os.path.join(*filename), metrics)
+                finish_tile(os.path.join(*filename), dict(meta, **metrics))
+            except TimeoutError:
+                pending.append((pos, os.path.join(*filename), meta, future))
 
-                filename = [OUTPUT_DIRECTORY, "{:05}-{:05}-{:05}_{:06.3f}_{:06.3f}{}".format(
-                    num_pos, i, j,
-                    ring[j][0], ring[j][1],
-                    FILE_EXTENSION
-                )]
+            # catch-up pass for late quality results at the end of every ring
 
-                if filename is None:
-                    raise Exception("could not acquire filename")
+            if n == total_pos-1 or rings[n+1] != i:
+                for pending_pos, pending_path, pending_meta, pending_future in pending:
+                    metrics = pending_future.result()
 
-                camera.capture(os.path.join(*filename))
+                    if len(quality.get_failures(metrics)) > 0:
+                        log.info("catch-up: returning to {}".format(os.path.basename(pending_path)))
+                        move_to(pending_pos)
 
-                log.debug("FILE: {}".format(filename[1]))
+                    metrics = retake_until_ok(pending_path, metrics)
+                    finish_tile(pending_path, dict(pending_meta, late_check=True, **metrics))
 
-                time.sleep(POST_CAPTURE_WAIT)
+                pending = []
 
         # return to home
 
@@ -458,6 +511,12 @@ if __name__ == "__main__":
 
         wait_for_idle()
 
+        quality_worker.shutdown()
+
+        if sender is not None:
+            log.info("waiting for tile transfer to finish")
+            sender.close()
+
         log.info("DONE")
 
     elif args["command"] == MODE_CALIBRATE: 
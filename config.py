@@ -0,0 +1,34 @@
+import os
+import json
+
+# Rig specific constants determined by calibration.py. cam.py and
+# processing.py read their defaults through get(), so a calibration run
+# changes both without editing the scripts.
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scancam.json")
+
+
+def load(path=CONFIG_FILE):
+
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def get(key, default, path=CONFIG_FILE):
+
+    return load(path).get(key, default)
+
+
+def save(values, path=CONFIG_FILE):
+
+    # merge, keep values written by earlier calibrations
+
+    data = load(path)
+    data.update(values)
+
+    with open(path, "w") as f:
+        json.dump(data, f, indent=4, sort_keys=True)
+        f.write("\n")
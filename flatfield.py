@@ -0,0 +1,123 @@
+import os
+import sys
+import argparse
+
+import cv2
+import numpy as np
+
+# Flat-field correction for the lensless sensor (vignetting and color
+# shading). The gain map is the per-channel mean of a median of blank target
+# captures divided by that median, stored once per decode level in the
+# orientation of the captured image:
+#
+#   python3 flatfield.py <dir with blank captures>
+
+FLATFIELD_FILE          = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flatfield.npz")
+
+SMOOTH_SIGMA            = 0.01      # relative to the image width, removes noise and dust
+MAX_GAIN                = 4.0
+
+_versions = {}
+_gains = {}
+
+
+def build_gain_maps(paths, levels, read_tile):
+
+    gains = {}
+
+    for level in levels:
+        frames = np.array([read_tile(path, level) for path in paths])
+        flat = np.median(frames, axis=0).astype(np.float32)
+
+        flat = cv2.GaussianBlur(flat, (0, 0), SMOOTH_SIGMA * flat.shape[1])
+        flat = np.maximum(flat, 1)
+
+        gain = flat.mean(axis=(0, 1)) / flat
+        gains[level] = np.clip(gain, 1/MAX_GAIN, MAX_GAIN).astype(np.float32)
+
+    return gains
+
+
+def save_gain_maps(gains, path=FLATFIELD_FILE):
+
+    np.savez(path, **{"level{}".format(level): gain for level, gain in gains.items()})
+
+    # drop what this process resolved from the previous file
+    _versions.pop(path, None)
+    for key in [key for key in _gains if key[0] == path]:
+        del _gains[key]
+
+
+def get_version(path=FLATFIELD_FILE):
+
+    # changes whenever the gain maps are rebuilt, 0 without flat-field.
+    # Resolved once per run, it is part of the key of every decoded tile
+
+    if path not in _versions:
+        _versions[path] = os.stat(path).st_mtime_ns if os.path.exists(path) else 0
+
+    return _versions[path]
+
+
+def get_gain(level, flip_horizontal, flip_vertical, path=FLATFIELD_FILE):
+
+    # gain map for a tile decoded at level and flipped like it, None if there
+    # is no flat-field. Flipped once here instead of for every tile
+
+    key = (path, level, flip_horizontal, flip_vertical)
+
+    if key not in _gains:
+        gain = None
+
+        if get_version(path) != 0:
+            with np.load(path) as data:
+                name = "level{}".format(level)
+
+                if name in data.files:
+                    gain = data[name]
+
+            if gain is not None:
+                if flip_horizontal:
+                    gain = gain[:, ::-1]
+                if flip_vertical:
+                    gain = gain[::-1, :]
+
+                gain = np.ascontiguousarray(gain)
+
+        _gains[key] = gain
+
+    return _gains[key]
+
+
+def apply(img, gain):
+
+    # single saturating multiply, in place
+
+    if img.shape != gain.shape:
+        raise Exception("flat-field shape {} does not match tile shape {}".format(gain.shape, img.shape))
+
+    return cv2.multiply(img, gain, dst=img, dtype=cv2.CV_8U)
+
+
+if __name__ == "__main__":
+
+    import processing
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("input_dir", help="directory with captures of a blank target")
+    args = vars(ap.parse_args())
+
+    paths = [os.path.join(args["input_dir"], f) for f in sorted(os.listdir(args["input_dir"]))
+        if f.lower().endswith(processing.FILE_EXTENSION) and not f.startswith(".")]
+
+    if len(paths) < 3:
+        print("need at least 3 blank captures for the median, found {}".format(len(paths)))
+        sys.exit(-1)
+
+    gains = build_gain_maps(paths, range(0, processing.MAX_DECODE_LEVEL+1), processing.read_tile)
+    save_gain_maps(gains)
+
+    for level, gain in gains.items():
+        print("level {}: {}x{} gain {:.2f} to {:.2f}".format(level, gain.shape[1], gain.shape[0], gain.min(), gain.max()))
+
+    print("written to {}".format(FLATFIELD_FILE))
@@ -0,0 +1,137 @@
+import math
+
+import numpy as np
+
+# Shared scan geometry for cam.py (planner), test.py (simulator) and
+# processing.py (stitcher). All functions work on whole scans at once:
+# positions are (N, 2) arrays of [offset, angle], footprints are (N, 4, 2)
+# arrays of corner points. Angles are in degrees.
+
+def rotate_points(points, angles, center=[0, 0]):
+
+    # points: (..., 2), angles: broadcastable to points[..., 0]
+
+    points = np.asarray(points, dtype=np.float64)
+    center = np.asarray(center, dtype=np.float64)
+    angles = np.radians(np.asarray(angles, dtype=np.float64))
+
+    s = np.sin(angles)
+    c = np.cos(angles)
+
+    x = points[..., 0] - center[0]
+    y = points[..., 1] - center[1]
+
+    return np.stack([x * c - y * s + center[0], x * s + y * c + center[1]], axis=-1)
+
+
+def get_positions(diameter, sensor_size, serpentine=True):
+
+    # returns (positions, rings, stops) with one row per capture in scan order:
+    # positions [offset, angle], ring index and index of the stop within its ring
+
+    # calculate min number of rings without gaps (ceil will introduce necessary overlap)
+    # ring0 is always at center, so subtract half a sensor size
+    num_rings = max(math.ceil((diameter-sensor_size[1])/2/sensor_size[1]), 1)
+    ring_offsets = np.arange(num_rings) * sensor_size[1]
+
+    # when computing the circumference do not use the center of the sensor
+    # but the middle of the top border of the sensor (to avoid gaps)
+    circ = 2 * np.pi * (ring_offsets + sensor_size[1]/2)
+    num_stops = np.ceil(circ/sensor_size[0]).astype(int)
+    num_stops[0] = 1
+
+    rings = np.repeat(np.arange(num_rings), num_stops)
+    ring_start = np.repeat(np.cumsum(num_stops) - num_stops, num_stops)
+    stops = np.arange(len(rings)) - ring_start
+
+    # traverse backwards in every second ring
+    steps = stops.copy()
+    if serpentine:
+        odd = rings % 2 == 1
+        steps[odd] = num_stops[rings[odd]] - 1 - stops[odd]
+
+    angles = steps / num_stops[rings] * 360
+    angles[rings == 0] = 0
+
+    positions = np.stack([ring_offsets[rings], angles], axis=-1)
+
+    return positions, rings, stops
+
+
+def get_rotated_sensors(offsets, angles, sensor_size, center=[0, 0], tangential_offset=0):
+
+    # footprint corners of every sensor position, order CW. tangential_offset
+    # shifts the sensor perpendicular to the carriage axis (misalignment)
+
+    offsets = np.asarray(offsets, dtype=np.float64)
+
+    template = np.array([
+        [-sensor_size[0]/2, -sensor_size[1]/2],
+        [+sensor_size[0]/2, -sensor_size[1]/2],
+        [+sensor_size[0]/2, +sensor_size[1]/2],
+        [-sensor_size[0]/2, +sensor_size[1]/2],
+    ])
+
+    points = np.broadcast_to(template, offsets.shape + (4, 2)).copy()
+    points[..., 0] += tangential_offset
+    points[..., 1] += offsets[..., np.newaxis]
+
+    # ignore center when rotating, translate afterwards
+    points = rotate_points(points, np.asarray(angles, dtype=np.float64)[..., np.newaxis])
+
+    return points + np.asarray(center, dtype=np.float64)
+
+
+def get_bounding_boxes(corners):
+
+    # (N, 4, 2) corners to (N, 4) boxes [xmin, ymin, xmax, ymax]
+
+    corners = np.asarray(corners)
+
+    return np.concatenate([corners.min(axis=-2), corners.max(axis=-2)], axis=-1)
+
+
+def get_homographies(image_res, corners):
+
+    # homographies mapping the full image rectangle [0, 0, w, h] onto
+    # each footprint quad (closed form square-to-quad mapping, no solver)
+
+    corners = np.asarray(corners, dtype=np.float64)
+
+    x0, y0 = corners[..., 0, 0], corners[..., 0, 1]
+    x1, y1 = corners[..., 1, 0], corners[..., 1, 1]
+    x2, y2 = corners[..., 2, 0], corners[..., 2, 1]
+    x3, y3 = corners[..., 3, 0], corners[..., 3, 1]
+
+    sx = x0 - x1 + x2 - x3
+    sy = y0 - y1 + y2 - y3
+    dx1 = x1 - x2
+    dx2 = x3 - x2
+    dy1 = y1 - y2
+    dy2 = y3 - y2
+
+    den = dx1 * dy2 - dx2 * dy1
+    g = (sx * dy2 - dx2 * sy) / den
+    h = (dx1 * sy - sx * dy1) / den
+
+    m = np.empty(corners.shape[:-2] + (3, 3))
+    m[..., 0, 0] = (x1 - x0 + g * x1) / image_res[0]
+    m[..., 0, 1] = (x3 - x0 + h * x3) / image_res[1]
+    m[..., 0, 2] = x0
+    m[..., 1, 0] = (y1 - y0 + g * y1) / image_res[0]
+    m[..., 1, 1] = (y3 - y0 + h * y3) / image_res[1]
+    m[..., 1, 2] = y0
+    m[..., 2, 0] = g / image_res[0]
+    m[..., 2, 1] = h / image_res[1]
+    m[..., 2, 2] = 1
+
+    return m
+
+
+def get_footprints(offsets, angles, sensor_size, image_res, center=[0, 0], tangential_offset=0):
+
+    # everything the stitcher needs for a whole scan in one pass
+
+    corners = get_rotated_sensors(offsets, angles, sensor_size, center=center, tangential_offset=tangential_offset)
+
+    return corners, get_bounding_boxes(corners), get_homographies(image_res, corners)
@@ -1,11 +1,19 @@
 import os
 import math
 import sys
+import argparse
+import hashlib
+import atexit
 
 from PIL import Image, ImageDraw
 import cv2
 import numpy as np
 
+import config
+import flatfield
+import geometry
+import tilecache
+
 INPUT_DIR       = "input13"
 OUTPUT_DIR      = "output"
 
@@ -19,55 +27,449 @@ FLIP_VERTICAL   = True
 DRAW_OUTLINE    = False
 
 DIAMETER        = 100 * SCALE_FACTOR
-SENSOR_SIZE     = [3.6 * SCALE_FACTOR * SHRINK_SENSOR, 2.7 * SCALE_FACTOR * SHRINK_SENSOR]
+SENSOR_SIZE_MM  = [3.6 * SHRINK_SENSOR, 2.7 * SHRINK_SENSOR]
 IMAGE_RES       = [2592, 1944]
 
 IMAGE_SIZE      = [1100, 1100]
 
-DIAM_OFFSET     = 0
+FILE_EXTENSION  = ".jpg"
+
+# sensor offset from the rotation axis at X=0 [mm], see calibration.py
+DIAM_OFFSET     = config.get("DIAM_OFFSET", 0)
+TANG_OFFSET     = config.get("TANGENTIAL_OFFSET", 0)
+
+# ROI MODE
+INDEX_CELL_SIZE = 5.0 # mm, grid cell size of the footprint index
+
+# DECODING
+MAX_DECODE_LEVEL = 3 # pyramid level n decodes at 1/2^n size, JPEG DCT scaling up to 1/8
+TILE_CACHE_DIR  = os.path.join(OUTPUT_DIR, "tilecache")
+TILE_CACHE_SIZE = 4 * 1024**3 # bytes
+
+# INCREMENTAL MODE
+STATE_FILE      = "state.npz"
+THUMB_SIZE      = [64, 48]
+CHANGE_THRESHOLD = 3.0 # mean abs difference of grayscale thumbnails [0-255]
+CHANGE_MAP_GAIN = 8
 
 files = []
+tile_cache = None
+
+def get_files(input_dir):
+
+    found = []
+
+    for (dirpath, dirnames, filenames) in os.walk(input_dir):
+        for f in filenames:
+
+            # skip .DS_Store, transfer metadata and partial transfers
+            if not f.lower().endswith(FILE_EXTENSION) or f.startswith("."):
+                continue
+
+            found.append([dirpath, f])
+
+    return sorted(found)
+
+def parse_filename(filename):
+
+    # naming convention
+    # filename = [OUTPUT_DIR, "{:05}-{:05}-{:05}_{:06.3f}_{:06.3f}{}".format(
+    #     num_pos, i, j,
+    #     ring[j][0], ring[j][1],
+    #     FILE_EXTENSION
+    # )]
+
+    coords = os.path.splitext(filename)[0].split("_")
+
+    return (float(coords[1]), float(coords[2]))
+
+def get_decode_level(scale):
+
+    # coarsest level that still has at least 2 tile pixels per output pixel
+    px_per_mm = IMAGE_RES[0] / SENSOR_SIZE_MM[0]
+
+    level = 0
+    while level < MAX_DECODE_LEVEL and px_per_mm / 2**(level+1) >= 2 * scale:
+        level += 1
+
+    return level
+
+def read_tile(path, level=0):
+
+    # decode only, as captured (unflipped)
+
+    flags = [cv2.IMREAD_COLOR, cv2.IMREAD_REDUCED_COLOR_2, cv2.IMREAD_REDUCED_COLOR_4, cv2.IMREAD_REDUCED_COLOR_8]
+    img = cv2.imread(path, flags[level])
+
+    if img is None:
+        raise Exception("could not decode image: {}".format(path))
+
+    return img
+
+def flip_tile(img, flip_horizontal, flip_vertical):
+
+    # in place, no second full size tile
+
+    if flip_horizontal and flip_vertical:
+        cv2.flip(img, -1, dst=img)
+    elif flip_horizontal:
+        cv2.flip(img, 1, dst=img)
+    elif flip_vertical:
+        cv2.flip(img, 0, dst=img)
+
+    return img
+
+def decode_tile(path, level=0):
+
+    # flip input image in both axes
+    img = flip_tile(read_tile(path, level), FLIP_HORIZONTAL, FLIP_VERTICAL)
+
+    # the gain map is stored pre-flipped, so the correction is one in-place
+    # multiply on the decoded tile
+    gain = flatfield.get_gain(level, FLIP_HORIZONTAL, FLIP_VERTICAL)
+
+    if gain is not None:
+        img = flatfield.apply(img, gain)
+
+    return img
+
+def get_decode_variant():
+
+    # everything besides path and level that changes a decoded tile
+    return "h{:d}v{:d}f{}".format(FLIP_HORIZONTAL, FLIP_VERTICAL, flatfield.get_version())
+
+def load_tile(path, level=0):
+
+    # flipped tile at the given decode level, from the tile cache if possible
+
+    if tile_cache is None:
+        return decode_tile(path, level)
+
+    variant = get_decode_variant()
+    img = tile_cache.get(path, level, variant)
+
+    if img is None:
+        img = tile_cache.put(path, level, decode_tile(path, level), variant)
+
+    return img
+
+def warp_tile(shape, img, rot_points, h):
+
+    # warp only into the bounding box of the footprint (clipped to the output)
+    # instead of into a full size canvas. h maps IMAGE_RES pixel coordinates
+    # onto the footprint, rescale if the tile was decoded at a different size
+
+    pts = np.asarray(rot_points, dtype=np.float64)
+
+    x0 = max(int(math.floor(pts[:, 0].min())), 0)
+    y0 = max(int(math.floor(pts[:, 1].min())), 0)
+    x1 = min(int(math.ceil(pts[:, 0].max())) + 1, shape[1])
+    y1 = min(int(math.ceil(pts[:, 1].max())) + 1, shape[0])
+
+    if x0 >= x1 or y0 >= y1:
+        return None
+
+    pts = pts - [x0, y0]
+
+    shift = np.array([[1, 0, -x0], [0, 1, -y0], [0, 0, 1]], dtype=np.float64)
+    scale = np.diag([IMAGE_RES[0]/img.shape[1], IMAGE_RES[1]/img.shape[0], 1])
+
+    img_overlay = cv2.warpPerspective(img, shift @ h @ scale, (x1-x0, y1-y0))
+
+    return (slice(y0, y1), slice(x0, x1)), pts.astype(np.int32), img_overlay
+
+def composite_tile(img_out, img, rot_points, h, owner=None, tile_id=0):
+
+    # owner (optional, int32) records which tile painted each pixel last.
+    # Returns bbox and footprint polygon (relative to bbox), None if outside
+
+    warped = warp_tile(img_out.shape, img, rot_points, h)
+
+    if warped is None:
+        return None
+
+    bbox, pts, img_overlay = warped
+
+    roi = img_out[bbox]
+    cv2.fillConvexPoly(roi, pts, 0, cv2.LINE_AA)
+    roi += img_overlay
+
+    if owner is not None:
+        cv2.fillConvexPoly(owner[bbox], pts, tile_id)
+
+    if DRAW_OUTLINE:
+        cv2.polylines(roi, [pts], isClosed=True, color=(125, 125, 125), thickness=1, lineType=cv2.LINE_AA)
+
+    return bbox, pts
+
+def patch_tile(img_out, owner, tile_id, img, rot_points, h):
+
+    # replace a tile in a finished mosaic: only the pixels it still owns are
+    # overwritten, tiles painted on top of it later stay untouched
+
+    warped = warp_tile(img_out.shape, img, rot_points, h)
+
+    if warped is None:
+        return None
+
+    bbox, pts, img_overlay = warped
+
+    mask = owner[bbox] == tile_id
+    img_out[bbox][mask] = img_overlay[mask]
+
+    return bbox, mask
+
+def get_scan_footprints(files, sensor_size, scale=1, center=[0, 0]):
+
+    # corners, bounding boxes and homographies of all tiles in one pass
+
+    coords = np.array([parse_filename(f[1]) for f in files], dtype=np.float64).reshape(-1, 2)
+
+    return geometry.get_footprints(
+        (coords[:, 0] + DIAM_OFFSET) * scale, coords[:, 1],
+        [sensor_size[0] * scale, sensor_size[1] * scale],
+        IMAGE_RES, center=center, tangential_offset=TANG_OFFSET * scale)
+
+def stitch_tile(img_out, f, center):
+
+    # single tile version of the full render loop, for tiles arriving one by one.
+    # Returns what composite_tile painted
+
+    corners, bboxes, homographies = get_scan_footprints([f], SENSOR_SIZE_MM, scale=SCALE_FACTOR, center=center)
+    img = load_tile(os.path.join(f[0], f[1]), get_decode_level(SCALE_FACTOR))
+
+    return composite_tile(img_out, img, corners[0], homographies[0])
+
+def get_content_hash(path):
 
-def rotate_point(xy, angle, center=[0, 0]):
+    h = hashlib.sha1()
 
-    s = math.sin(math.radians(angle))
-    c = math.cos(math.radians(angle))
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
 
-    x = (xy[0]-center[0]) * c - (xy[1]-center[1]) * s + center[0]
-    y = (xy[0]-center[0]) * s + (xy[1]-center[1]) * c + center[1]
+    return h.hexdigest()
 
-    return (x, y)
+def get_thumbnail(path):
 
-def get_rotated_sensor(offset, angle, sensor_size, center=[0, 0]):
+    # the JPEG decoder scales by 1/8 in the DCT domain, much cheaper than a full decode
+    img = cv2.imread(path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
 
-    # order CW
-    points = [
-        [-sensor_size[0]/2, offset-sensor_size[1]/2],
-        [+sensor_size[0]/2, offset-sensor_size[1]/2],
-        [+sensor_size[0]/2, offset+sensor_size[1]/2],
-        [-sensor_size[0]/2, offset+sensor_size[1]/2],
-    ]
+    if img is None:
+        raise Exception("could not decode image: {}".format(path))
 
-    points = [rotate_point(xy, angle) for xy in points] # ignore center here
-    points = [(xy[0] + center[0], xy[1] + center[1]) for xy in points]
+    return cv2.resize(img, tuple(THUMB_SIZE), interpolation=cv2.INTER_AREA)
 
-    return points
+def get_render_params():
+
+    # a cached mosaic is only reusable if none of these changed
+    return np.array([SCALE_FACTOR, SHRINK_SENSOR, DIAM_OFFSET, TANG_OFFSET, FLIP_HORIZONTAL, FLIP_VERTICAL, *IMAGE_SIZE, *IMAGE_RES, flatfield.get_version()], dtype=np.float64)
+
+def get_position_keys(files):
+
+    return np.array(["{:.3f}_{:.3f}".format(*parse_filename(f[1])) for f in files])
+
+def save_state(path, files, hashes, thumbs, img_out, owner):
+
+    np.savez(path,
+        params=get_render_params(),
+        keys=get_position_keys(files),
+        hashes=np.array(hashes),
+        thumbs=np.array(thumbs, dtype=np.uint8).reshape(-1, THUMB_SIZE[1], THUMB_SIZE[0]),
+        mosaic=img_out,
+        owner=owner)
+
+def load_state(path, files):
+
+    # returns None if there is no previous render of the same positions
+
+    if not os.path.exists(path):
+        return None
+
+    with np.load(path) as data:
+        state = {key: data[key] for key in data.files}
+
+    if not np.array_equal(state["params"], get_render_params()):
+        print("render parameters changed, ignoring previous state")
+        return None
+
+    if not np.array_equal(state["keys"], get_position_keys(files)):
+        print("scan positions changed, ignoring previous state")
+        return None
+
+    return state
+
+def render_incremental(files, state, center):
+
+    # compare position by position with the previous scan, re-decode and
+    # re-composite only tiles whose content hash and thumbnail both changed
+
+    img_out = state["mosaic"].copy()
+    owner = state["owner"]
+    hashes = state["hashes"].tolist()
+    thumbs = state["thumbs"].copy()
+
+    changes = np.zeros(img_out.shape[0:2], dtype=np.uint8)
+
+    corners, bboxes, homographies = get_scan_footprints(files, SENSOR_SIZE_MM, scale=SCALE_FACTOR, center=center)
+
+    num_changed = 0
+
+    for i in range(0, len(files)):
+        f = files[i]
+        path = os.path.join(f[0], f[1])
+
+        content_hash = get_content_hash(path)
+        if content_hash == hashes[i]:
+            continue
+
+        thumb = get_thumbnail(path)
+        diff = np.mean(np.abs(thumb.astype(np.int16) - thumbs[i]))
+
+        if diff < CHANGE_THRESHOLD:
+            # keep hash and thumb of the tile that is in the mosaic, so slow
+            # drift is still compared against what was rendered
+            continue
+
+        print("changed: {} (diff {:.2f})".format(f[1], diff))
+
+        patched = patch_tile(img_out, owner, i, load_tile(path, get_decode_level(SCALE_FACTOR)), corners[i], homographies[i])
+
+        if patched is not None:
+            bbox, mask = patched
+            changes[bbox][mask] = min(255, int(diff * CHANGE_MAP_GAIN))
+
+        hashes[i] = content_hash
+        thumbs[i] = thumb
+        num_changed += 1
+
+    print("{} of {} tiles changed".format(num_changed, len(files)))
+
+    return img_out, owner, hashes, thumbs, changes
+
+def build_footprint_index(files, sensor_size, cell_size=INDEX_CELL_SIZE):
+
+    # footprints in disk millimeters (origin at the disk center, y pointing down
+    # like in the output image), computed from filename coordinates only
+
+    corners, bboxes, homographies = get_scan_footprints(files, sensor_size)
+
+    # uniform grid: every cell lists the tiles whose bounding box touches it
+    cells = {}
+    for i in range(0, len(bboxes)):
+        cx0, cy0 = np.floor(bboxes[i, 0:2] / cell_size).astype(int)
+        cx1, cy1 = np.floor(bboxes[i, 2:4] / cell_size).astype(int)
+
+        for cx in range(cx0, cx1+1):
+            for cy in range(cy0, cy1+1):
+                cells.setdefault((cx, cy), []).append(i)
+
+    return {
+        "files": files,
+        "corners": corners,
+        "bboxes": bboxes,
+        "homographies": homographies,
+        "cells": cells,
+        "cell_size": cell_size
+    }
+
+def query_footprint_index(index, window):
+
+    x0, y0, x1, y1 = window
+    cell_size = index["cell_size"]
+
+    candidates = set()
+    for cx in range(int(math.floor(x0 / cell_size)), int(math.floor(x1 / cell_size))+1):
+        for cy in range(int(math.floor(y0 / cell_size)), int(math.floor(y1 / cell_size))+1):
+            candidates.update(index["cells"].get((cx, cy), []))
+
+    bboxes = index["bboxes"]
+    hits = [i for i in candidates if
+        bboxes[i, 0] < x1 and bboxes[i, 2] > x0 and
+        bboxes[i, 1] < y1 and bboxes[i, 3] > y0]
+
+    # keep capture order, later tiles are painted over earlier ones
+    return sorted(hits)
+
+def render_roi(index, window, scale):
+
+    x0, y0, x1, y1 = window
+
+    width = int(math.ceil((x1-x0) * scale))
+    height = int(math.ceil((y1-y0) * scale))
+
+    img_out = np.zeros([height, width, 3], dtype=np.uint8)
+
+    level = get_decode_level(scale)
+
+    hits = query_footprint_index(index, window)
+    print("ROI: {} of {} tiles intersect the window".format(len(hits), len(index["files"])))
+
+    for i in hits:
+        f = index["files"][i]
+
+        print("processing: {}".format(f[1]))
+
+        # footprints are indexed in mm, map them into the output window
+        to_window = np.array([[scale, 0, -x0*scale], [0, scale, -y0*scale], [0, 0, 1]])
+
+        rot_points = (index["corners"][i] - [x0, y0]) * scale
+        h = to_window @ index["homographies"][i]
+
+        composite_tile(img_out, load_tile(os.path.join(f[0], f[1]), level), rot_points, h)
+
+    return img_out
 
 if __name__ == "__main__":
 
-    if len(sys.argv) > 1:
-        INPUT_DIR = sys.argv[1]
-        print("INPUT_DIR: {}".format(INPUT_DIR))
+    ap = argparse.ArgumentParser()
+    ap.add_argument("input_dir", nargs="?", default=INPUT_DIR, help="directory with captured tiles")
+    ap.add_argument("--roi", type=float, nargs=4, metavar=("X0", "Y0", "X1", "Y1"), help="render only this window [mm, relative to disk center]")
+    ap.add_argument("--scale", type=float, default=SCALE_FACTOR, help="output scale for ROI mode [px/mm]")
+    ap.add_argument("--no-cache", action="store_true", default=False, help="always decode tiles, do not use the tile cache")
+    ap.add_argument("--incremental", action="store_true", default=False, help="re-render only tiles that changed since the last run")
+    args = vars(ap.parse_args())
 
-    for (dirpath, dirnames, filenames) in os.walk(INPUT_DIR):
-        for f in filenames:
+    INPUT_DIR = args["input_dir"]
+    print("INPUT_DIR: {}".format(INPUT_DIR))
 
-            if f.lower() == ".ds_store":
-                continue
+    files = get_files(INPUT_DIR)
+
+    if not args["no_cache"]:
+        tile_cache = tilecache.TileCache(TILE_CACHE_DIR, TILE_CACHE_SIZE)
+        atexit.register(tile_cache.save)
+
+    if args["roi"] is not None:
+
+        window = args["roi"]
+
+        if window[0] >= window[2] or window[1] >= window[3]:
+            print("invalid ROI window: {}".format(window))
+            sys.exit(-1)
+
+        index = build_footprint_index(files, SENSOR_SIZE_MM)
+        img_out = render_roi(index, window, args["scale"])
 
-            files.append([dirpath, f])
+        cv2.imwrite(os.path.join(OUTPUT_DIR, "roi_{:.2f}_{:.2f}_{:.2f}_{:.2f}_{:.1f}.png".format(*window, args["scale"])), img_out)
 
-    files = sorted(files)
+        sys.exit(0)
+
+    if args["incremental"]:
+
+        state = load_state(os.path.join(OUTPUT_DIR, STATE_FILE), files)
+
+        if state is not None:
+
+            center = [IMAGE_SIZE[0]/2, IMAGE_SIZE[1]/2]
+            img_out, owner, hashes, thumbs, changes = render_incremental(files, state, center)
+
+            cv2.imwrite(os.path.join(OUTPUT_DIR, "output.png"), img_out)
+            cv2.imwrite(os.path.join(OUTPUT_DIR, "changes.png"), changes)
+            save_state(os.path.join(OUTPUT_DIR, STATE_FILE), files, hashes, thumbs, img_out, owner)
+
+            sys.exit(0)
+
+        print("no usable previous state, rendering everything")
 
     with Image.new(mode="RGB", size=IMAGE_SIZE) as output_image:
         draw = ImageDraw.Draw(output_image, "RGBA")
@@ -75,60 +477,28 @@ if __name__ == "__main__":
 
         center = [IMAGE_SIZE[0]/2, IMAGE_SIZE[1]/2]
 
-        img_out = np.array(output_image) 
+        img_out = np.array(output_image)
         img_out = img_out[:, :, ::-1].copy() # RGB to BGR
 
+        corners, bboxes, homographies = get_scan_footprints(files, SENSOR_SIZE_MM, scale=SCALE_FACTOR, center=center)
+
+        owner = np.full(img_out.shape[0:2], -1, dtype=np.int32)
+
         for i in range(0, len(files)):
             f = files[i]
 
             print("processing: {}".format(f[1]))
 
-            # naming convention
-            # filename = [OUTPUT_DIR, "{:05}-{:05}-{:05}_{:06.3f}_{:06.3f}{}".format(
-            #     num_pos, i, j,
-            #     ring[j][0], ring[j][1],
-            #     FILE_EXTENSION
-            # )]
-
-            coords = os.path.splitext(f[1])[0].split("_")
+            img = load_tile(os.path.join(f[0], f[1]), get_decode_level(SCALE_FACTOR))
 
-            dist = (float(coords[1]) + DIAM_OFFSET) * SCALE_FACTOR
-            rot = float(coords[2])
-
-            img = cv2.imread(os.path.join(f[0], f[1]))
-
-            # flip input image in both axes
-            img = cv2.flip(img, -1)
-
-            avg_color_per_row = np.average(img, axis=0)
-            avg_color = np.average(avg_color_per_row, axis=0)
-
-            rot_points = get_rotated_sensor(dist, rot, SENSOR_SIZE, center=center)
+            rot_points = corners[i]
 
             # PIL polygon
             # draw.polygon(
-            #     rot_points, 
-            #     #fill=(int(avg_color[0]), int(avg_color[1]), int(avg_color[2]), int(255/2)), 
+            #     rot_points,
             #     outline=(255, 255, 255, 40))
 
-
-            # compute the transformation
-
-            pts_src = np.array([
-                (0, 0),
-                (IMAGE_RES[0], 0),
-                (IMAGE_RES[0], IMAGE_RES[1]),
-                (0, IMAGE_RES[1])
-            ])
-
-            h, status = cv2.findHomography(pts_src, np.array(rot_points))
-            img_overlay = cv2.warpPerspective(img, h, (img_out.shape[1], img_out.shape[0]))
-
-            cv2.fillConvexPoly(img_out, np.array(rot_points, np.int32), 0, cv2.LINE_AA)
-            img_out = img_out + img_overlay
-            
-            if DRAW_OUTLINE:
-                cv2.polylines(img_out, [np.array(rot_points, np.int32)], isClosed=True, color=(125, 125, 125), thickness=1, lineType=cv2.LINE_AA)
+            composite_tile(img_out, img, rot_points, homographies[i], owner=owner, tile_id=i)
 
             # cv2.imwrite(os.path.join(OUTPUT_DIR, "{:05}_overlay.png".format(i)), img_overlay)
             cv2.imwrite(os.path.join(OUTPUT_DIR, "{:05}.png".format(i)), img_out)
@@ -140,3 +510,10 @@ if __name__ == "__main__":
 
         # img_out = cv2.cvtColor(img_out, cv2.COLOR_BGR2GRAY)
         cv2.imwrite(os.path.join(OUTPUT_DIR, "output.png"), img_out)
+
+        if args["incremental"]:
+            paths = [os.path.join(f[0], f[1]) for f in files]
+            save_state(os.path.join(OUTPUT_DIR, STATE_FILE), files,
+                [get_content_hash(p) for p in paths],
+                [get_thumbnail(p) for p in paths],
+                img_out, owner)
@@ -0,0 +1,57 @@
+from PIL import Image
+import numpy as np
+
+# Cheap per-capture quality metrics, computed on a low resolution copy.
+# Thresholds depend on target and lighting, tune them on real captures.
+
+REDUCE_FACTOR           = 8         # JPEG draft mode decodes at 1/8 size in the DCT domain
+
+MIN_SHARPNESS           = 10.0      # variance of laplacian (blur: carriage not settled)
+MAX_CLIPPED             = 0.05      # fraction of pixels at 0 or 255
+MIN_BRIGHTNESS          = 20.0      # mean gray value [0-255]
+
+CLIP_LOW                = 2
+CLIP_HIGH               = 253
+
+
+def get_metrics(path):
+
+    try:
+        with Image.open(path) as img:
+            img.draft("L", (img.size[0] // REDUCE_FACTOR, img.size[1] // REDUCE_FACTOR))
+            gray = np.asarray(img.convert("L"), dtype=np.float32)
+    except OSError as e:
+        # truncated or missing capture, fails the check like a blurred one
+        # instead of aborting the scan
+        return {"error": str(e)}
+
+    laplacian = (
+        gray[1:-1, :-2] + gray[1:-1, 2:] +
+        gray[:-2, 1:-1] + gray[2:, 1:-1] -
+        4 * gray[1:-1, 1:-1]
+    )
+
+    return {
+        "sharpness": float(laplacian.var()),
+        "clipped": float(np.mean((gray <= CLIP_LOW) | (gray >= CLIP_HIGH))),
+        "brightness": float(gray.mean())
+    }
+
+
+def get_failures(metrics):
+
+    if "error" in metrics:
+        return ["unreadable"]
+
+    failures = []
+
+    if metrics["sharpness"] < MIN_SHARPNESS:
+        failures.append("blurred")
+
+    if metrics["clipped"] > MAX_CLIPPED:
+        failures.append("clipped")
+
+    if metrics["brightness"] < MIN_BRIGHTNESS:
+        failures.append("dark")
+
+    return failures
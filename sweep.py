@@ -0,0 +1,224 @@
+import os
+import sys
+import math
+import argparse
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+import flatfield
+import geometry
+import processing
+
+# Renders every combination of a grid of stitch constants at preview
+# resolution, in parallel. Tiles are decoded once (unflipped) into a shared
+# memory stack that all workers map. Each variant gets a seam error: the mean
+# per-pixel standard deviation of the high-passed tiles where they overlap.
+#
+#   python3 sweep.py input13 --param DIAM_OFFSET=-0.5,0,0.5 --param FLIP_VERTICAL=0,1
+
+PREVIEW_SIZE            = 400       # px, width of a rendered variant
+PREVIEW_LEVEL           = 3         # decode level of the shared tiles (1/8)
+HIGHPASS_SIGMA          = 2.0       # px, at preview tile resolution
+
+SWEEP_PARAMS = {
+    "DIAM_OFFSET": float,
+    "TANG_OFFSET": float,
+    "SHRINK_SENSOR": float,
+    "SCALE_FACTOR": float,
+    "FLIP_HORIZONTAL": lambda v: v.lower() in ["1", "true", "yes"],
+    "FLIP_VERTICAL": lambda v: v.lower() in ["1", "true", "yes"],
+}
+
+# worker state, set by _init_worker
+_shm = None
+_tiles = None
+_coords = None
+
+
+def _init_worker(shm_name, shape, coords):
+
+    global _shm, _tiles, _coords
+
+    _shm = shared_memory.SharedMemory(name=shm_name)
+    _tiles = np.ndarray(shape, dtype=np.uint8, buffer=_shm.buf)
+    _coords = coords
+
+
+def _decode_into(job):
+
+    i, path = job
+    _tiles[i] = processing.read_tile(path, PREVIEW_LEVEL)
+
+    # flips differ per variant, correct in capture orientation
+    gain = flatfield.get_gain(PREVIEW_LEVEL, False, False)
+
+    if gain is not None:
+        flatfield.apply(_tiles[i], gain)
+
+
+def get_defaults():
+
+    return {
+        "DIAM_OFFSET": processing.DIAM_OFFSET,
+        "TANG_OFFSET": processing.TANG_OFFSET,
+        "SHRINK_SENSOR": processing.SHRINK_SENSOR,
+        "SCALE_FACTOR": processing.SCALE_FACTOR,
+        "FLIP_HORIZONTAL": processing.FLIP_HORIZONTAL,
+        "FLIP_VERTICAL": processing.FLIP_VERTICAL,
+    }
+
+
+def render_variant(params):
+
+    # same geometry and compositing as processing.py, at preview scale
+
+    ratio = PREVIEW_SIZE / processing.IMAGE_SIZE[0]
+    size = [PREVIEW_SIZE, int(round(processing.IMAGE_SIZE[1] * ratio))]
+    scale = params["SCALE_FACTOR"] * ratio
+    sensor_size = [3.6 * params["SHRINK_SENSOR"] * scale, 2.7 * params["SHRINK_SENSOR"] * scale]
+
+    corners, bboxes, homographies = geometry.get_footprints(
+        (_coords[:, 0] + params["DIAM_OFFSET"]) * scale, _coords[:, 1],
+        sensor_size, processing.IMAGE_RES,
+        center=[size[0]/2, size[1]/2], tangential_offset=params["TANG_OFFSET"] * scale)
+
+    img_out = np.zeros([size[1], size[0], 3], dtype=np.uint8)
+
+    # overlap statistics of the high-passed gray tiles
+    acc_sum = np.zeros(img_out.shape[0:2], dtype=np.float32)
+    acc_sq = np.zeros(img_out.shape[0:2], dtype=np.float32)
+    acc_count = np.zeros(img_out.shape[0:2], dtype=np.uint16)
+
+    for i in range(0, len(_tiles)):
+        # flip_tile works in place, the shared tiles are used by every variant
+        img = processing.flip_tile(_tiles[i].copy(), params["FLIP_HORIZONTAL"], params["FLIP_VERTICAL"])
+
+        if processing.composite_tile(img_out, img, corners[i], homographies[i]) is None:
+            continue
+
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY).astype(np.float32)
+        gray -= cv2.GaussianBlur(gray, (0, 0), HIGHPASS_SIGMA)
+
+        bbox, pts, gray_overlay = processing.warp_tile(img_out.shape, gray, corners[i], homographies[i])
+
+        # erode the footprint by a pixel, warped borders are blended with black
+        mask = np.zeros(gray_overlay.shape, dtype=np.uint8)
+        cv2.fillConvexPoly(mask, pts, 1)
+        mask = cv2.erode(mask, np.ones((3, 3), np.uint8)).astype(bool)
+
+        acc_sum[bbox][mask] += gray_overlay[mask]
+        acc_sq[bbox][mask] += gray_overlay[mask]**2
+        acc_count[bbox][mask] += 1
+
+    overlap = acc_count >= 2
+
+    if np.any(overlap):
+        n = acc_count[overlap].astype(np.float32)
+        variance = acc_sq[overlap] / n - (acc_sum[overlap] / n)**2
+        seam_error = float(np.mean(np.sqrt(np.maximum(variance, 0))))
+    else:
+        seam_error = float("nan")
+
+    return img_out, seam_error
+
+
+def get_contact_sheet(renders, labels):
+
+    cols = int(math.ceil(math.sqrt(len(renders))))
+    rows = int(math.ceil(len(renders) / cols))
+    h, w = renders[0].shape[0:2]
+
+    sheet = np.zeros([rows * h, cols * w, 3], dtype=np.uint8)
+
+    for i in range(0, len(renders)):
+        y, x = (i // cols) * h, (i % cols) * w
+        sheet[y:y+h, x:x+w] = renders[i]
+
+        for j, line in enumerate(labels[i]):
+            cv2.putText(sheet, line, (x + 5, y + 15 + j * 15), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1, cv2.LINE_AA)
+
+        cv2.rectangle(sheet, (x, y), (x + w - 1, y + h - 1), (80, 80, 80), 1)
+
+    return sheet
+
+
+def parse_grid(param_args):
+
+    grid = {}
+
+    for arg in param_args:
+        name, _, values = arg.partition("=")
+
+        if name not in SWEEP_PARAMS:
+            raise Exception("unknown sweep parameter {}, choose from {}".format(name, ", ".join(SWEEP_PARAMS.keys())))
+
+        grid[name] = [SWEEP_PARAMS[name](v) for v in values.split(",")]
+
+    names = list(grid.keys())
+    variants = []
+
+    for combination in itertools.product(*[grid[name] for name in names]):
+        params = get_defaults()
+        params.update(zip(names, combination))
+        variants.append(params)
+
+    return names, variants
+
+
+if __name__ == "__main__":
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("input_dir", help="directory with captured tiles")
+    ap.add_argument("--param", action="append", default=[], help="NAME=v1,v2,... (repeatable)")
+    ap.add_argument("--workers", type=int, default=os.cpu_count(), help="number of render processes")
+    args = vars(ap.parse_args())
+
+    names, variants = parse_grid(args["param"])
+
+    files = processing.get_files(args["input_dir"])
+
+    if len(files) == 0:
+        print("no tiles found in {}".format(args["input_dir"]))
+        sys.exit(-1)
+
+    paths = [os.path.join(f[0], f[1]) for f in files]
+    coords = np.array([processing.parse_filename(f[1]) for f in files], dtype=np.float64)
+
+    shape = (len(files),) + processing.read_tile(paths[0], PREVIEW_LEVEL).shape
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)))
+
+    try:
+        with multiprocessing.Pool(args["workers"], initializer=_init_worker, initargs=(shm.name, shape, coords)) as pool:
+
+            print("decoding {} tiles at level {}".format(len(files), PREVIEW_LEVEL))
+            pool.map(_decode_into, list(enumerate(paths)))
+
+            print("rendering {} variants on {} workers".format(len(variants), args["workers"]))
+            results = pool.map(render_variant, variants)
+
+    finally:
+        shm.close()
+        shm.unlink()
+
+    renders = [r[0] for r in results]
+    scores = [r[1] for r in results]
+
+    labels = []
+    for params, score in zip(variants, scores):
+        labels.append(["{}={}".format(name, params[name]) for name in names] + ["seam {:.2f}".format(score)])
+
+    os.makedirs(processing.OUTPUT_DIR, exist_ok=True)
+    cv2.imwrite(os.path.join(processing.OUTPUT_DIR, "sweep.png"), get_contact_sheet(renders, labels))
+
+    with open(os.path.join(processing.OUTPUT_DIR, "sweep.csv"), "w") as f:
+        f.write(",".join(names + ["seam_error"]) + "\n")
+        for params, score in zip(variants, scores):
+            f.write(",".join([str(params[name]) for name in names] + ["{:.4f}".format(score)]) + "\n")
+
+    print("")
+    for i in np.argsort(scores):
+        print("seam {:8.3f} | {}".format(scores[i], " ".join(labels[i][:-1])))
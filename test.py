@@ -1,5 +1,8 @@
 from PIL import Image, ImageDraw
-import math
+
+import numpy as np
+
+import geometry
 
 
 SCALE_FACTOR    = 10
@@ -9,79 +12,30 @@ SENSOR_SIZE     = [3.6 * SCALE_FACTOR, 2.7 * SCALE_FACTOR]
 
 IMAGE_SIZE      = [1100, 1100]
 
-def rotate_point(xy, angle, center=[0, 0]):
-
-    s = math.sin(math.radians(angle))
-    c = math.cos(math.radians(angle))
-
-    x = (xy[0]-center[0]) * c - (xy[1]-center[1]) * s + center[0]
-    y = (xy[0]-center[0]) * s + (xy[1]-center[1]) * c + center[1]
-
-    return (x, y)
-
-def get_rotated_sensor(offset, angle, sensor_size, center=[0, 0]):
-
-    # order CW
-    points = [
-        [-sensor_size[0]/2, offset-sensor_size[1]/2],
-        [+sensor_size[0]/2, offset-sensor_size[1]/2],
-        [+sensor_size[0]/2, offset+sensor_size[1]/2],
-        [-sensor_size[0]/2, offset+sensor_size[1]/2],
-    ]
-
-    points = [rotate_point(xy, angle) for xy in points] # ignore center here
-    points = [(xy[0] + center[0], xy[1] + center[1]) for xy in points]
-
-    return points
+positions, rings, stops = geometry.get_positions(DIAMETER, SENSOR_SIZE)
+ring_sizes = np.bincount(rings)
 
-def get_positions(diameter, sensor_size):
-
-    # calculate min number of rings without gaps (ceil will introduce necessary overlap)
-    # ring0 is always at center, so subtract half a sensor size
-    num_rings = math.ceil((diameter-sensor_size[1])/2/sensor_size[1])
-    ring_offsets = [x * sensor_size[1] for x in range(0, num_rings)]
-    positions_per_ring = []
-
-    for offset in ring_offsets:
-        if offset == 0:
-            positions_per_ring.append([[0, 0]])
-            continue
-
-        # when computing the circumference do not use the center of the sensor
-        # but the middle of the top border of the sensor (to avoid gaps)
-        circ = 2 * math.pi * (offset + sensor_size[1]/2)
-        num_stops = math.ceil(circ/sensor_size[0])
-
-        stops = []
-        for i in range(0, num_stops):
-            stops.append([offset, (i/num_stops) * 360]) # degree
-
-        positions_per_ring.append(stops)
-
-    return positions_per_ring
-
-positions_per_ring = get_positions(DIAMETER, SENSOR_SIZE)
-
-# for x in positions_per_ring:
+# for x in positions:
 #     print(x)
 
-for ring in positions_per_ring:
-    print("pos: {} stops: {}".format(ring[0][0], len(ring)))
+for i in range(0, len(ring_sizes)):
+    print("pos: {} stops: {}".format(positions[rings == i][0][0], ring_sizes[i]))
 
 with Image.new(mode="RGB", size=IMAGE_SIZE) as im:
     draw = ImageDraw.Draw(im, "RGBA")
     draw.rectangle((0, 0, *IMAGE_SIZE), fill=(0, 0, 0))
 
-    for ring in positions_per_ring:
+    center = [IMAGE_SIZE[0]/2, IMAGE_SIZE[1]/2]
+
+    corners = geometry.get_rotated_sensors(positions[:, 0], positions[:, 1], SENSOR_SIZE, center=center)
 
-        center = [IMAGE_SIZE[0]/2, IMAGE_SIZE[1]/2]
+    for i in range(0, len(ring_sizes)):
 
-        for pos in ring:
-            print(pos)
-            rot_points = get_rotated_sensor(pos[0], pos[1], SENSOR_SIZE, center=center)
-            draw.polygon(rot_points, fill=(255, 255, 255, 90), outline=(255, 255, 255, 125))
+        for n in np.flatnonzero(rings == i):
+            print(positions[n])
+            draw.polygon([tuple(xy) for xy in corners[n]], fill=(255, 255, 255, 90), outline=(255, 255, 255, 125))
 
-        x_coord = ring[0][0]
+        x_coord = positions[rings == i][0][0]
         draw.ellipse(
             (center[0]-x_coord, center[1]-x_coord, 
             center[0]+x_coord, center[1]+x_coord), 
@@ -104,9 +58,7 @@ with Image.new(mode="RGB", size=IMAGE_SIZE) as im:
     # print(rot_points)
     # draw.polygon(rot_points, outline=(255, 0, 0))
 
-    num_images = 0
-    for ring in positions_per_ring:
-        num_images += len(ring)
+    num_images = len(positions)
 
     print("images {} total time: {}m {}s (5s per img)".format(num_images, int(num_images*5/60), num_images*5%60))
 
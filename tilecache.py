@@ -0,0 +1,239 @@
+import io
+import os
+import json
+import heapq
+
+import numpy as np
+
+# Decoded tiles stored as uint8 arrays in memory mapped .npy stacks, one
+# stack per decode level and tile shape. Every slot of a stack holds one
+# tile, index.json maps "path|level|variant" to its slot together with the mtime of
+# the source file (stale entries are dropped on access). Entries are kept in
+# LRU order (least recently used first) for eviction. Reads return read-only
+# views into the memmap, no copy.
+#
+# Stacks start small and grow in steps of STACK_GROWTH bytes (the .npy header
+# is rewritten in place, numpy pads it for that), so no file is ever larger
+# than the slots it needs, sparse files or not. max_bytes bounds the size of
+# all stack files together: a new tile takes a free slot of its stack, else
+# the stack grows if the budget allows, else least recently used tiles are
+# evicted. A stack whose last entry is evicted is deleted.
+#
+# The index is written on exit. It is marked dirty on disk before the first
+# slot is (re)written in a run, so an interrupted run never leaves an index
+# pointing at foreign data: a dirty index is discarded on the next start.
+
+INDEX_FILE              = "index.json"
+INDEX_VERSION           = 3         # 1: keys without variant (tiles of any flip), 2: preallocated stacks
+
+STACK_GROWTH            = 64 * 1024**2 # bytes
+
+
+class TileCache(object):
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self.memmaps = {}
+        self.entries = {}
+        self.stacks = {}    # stack name -> {"shape", "slots", "free"}
+        self.disk_bytes = 0
+        self.dirty = False
+
+        os.makedirs(directory, exist_ok=True)
+
+        index_path = os.path.join(directory, INDEX_FILE)
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                index = json.load(f)
+
+            if index.get("version") == INDEX_VERSION and index.get("clean", False):
+                self.entries = index["entries"]
+                self.stacks = index["stacks"]
+                self.disk_bytes = sum(self._stack_bytes(name) for name in self.stacks)
+            else:
+                # older format or interrupted run, start over
+                self._remove_stacks()
+
+    def _remove_stacks(self):
+        for f in os.listdir(self.directory):
+            if f.endswith(".npy"):
+                os.remove(os.path.join(self.directory, f))
+
+    def _stack_bytes(self, name):
+        stack = self.stacks[name]
+        return stack["slots"] * int(np.prod(stack["shape"]))
+
+    def _get_memmap(self, name):
+        if name not in self.memmaps:
+            self.memmaps[name] = np.load(os.path.join(self.directory, name + ".npy"), mmap_mode="r+")
+
+        return self.memmaps[name]
+
+    def _resize_stack(self, name, slots):
+        # grows (or creates) the stack file in place, slots beyond the old
+        # end are added to the free list
+
+        stack = self.stacks[name]
+        path = os.path.join(self.directory, name + ".npy")
+
+        header = io.BytesIO()
+        np.lib.format.write_array_header_1_0(header, {
+            "descr": np.lib.format.dtype_to_descr(np.dtype(np.uint8)),
+            "fortran_order": False,
+            "shape": (slots,) + tuple(stack["shape"])
+        })
+        header = header.getvalue()
+
+        if name in self.memmaps:
+            self.memmaps[name].flush()
+            del self.memmaps[name]
+
+        with open(path, "r+b" if os.path.exists(path) else "w+b") as f:
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(0)
+                np.lib.format.read_magic(f)
+                np.lib.format.read_array_header_1_0(f)
+
+                if f.tell() != len(header):
+                    raise Exception("cannot resize tile cache stack {} in place".format(path))
+
+            f.seek(0)
+            f.write(header)
+            f.truncate(len(header) + slots * int(np.prod(stack["shape"])))
+
+        self.disk_bytes -= self._stack_bytes(name)
+
+        for slot in range(stack["slots"], slots):
+            heapq.heappush(stack["free"], slot)
+
+        stack["slots"] = slots
+        self.disk_bytes += self._stack_bytes(name)
+
+    def _remove_stack(self, name):
+        if name in self.memmaps:
+            del self.memmaps[name]
+
+        path = os.path.join(self.directory, name + ".npy")
+        if os.path.exists(path):
+            os.remove(path)
+
+        self.disk_bytes -= self._stack_bytes(name)
+        del self.stacks[name]
+
+    def _drop(self, key):
+        entry = self.entries.pop(key)
+        stack = self.stacks[entry["stack"]]
+
+        heapq.heappush(stack["free"], entry["slot"])
+
+        if len(stack["free"]) == stack["slots"]:
+            self._remove_stack(entry["stack"])
+
+    def _get_slot(self, name, shape):
+        # free slot for a new tile, grows the stack or evicts the least
+        # recently used tiles to make room
+
+        tile_bytes = int(np.prod(shape))
+
+        while True:
+            stack = self.stacks.get(name)
+
+            if stack is not None and len(stack["free"]) > 0:
+                return heapq.heappop(stack["free"])
+
+            room = (self.max_bytes - self.disk_bytes) // tile_bytes
+
+            if room > 0:
+                if stack is None:
+                    self.stacks[name] = stack = {"shape": list(shape), "slots": 0, "free": []}
+
+                grow = min(max(STACK_GROWTH // tile_bytes, 1), room)
+                self._resize_stack(name, stack["slots"] + grow)
+                continue
+
+            if len(self.entries) == 0:
+                return None
+
+            self._drop(next(iter(self.entries)))
+
+    def _mark_dirty(self):
+        # before the first slot write of this run, see above
+
+        if self.dirty:
+            return
+
+        self._save_index(clean=False)
+        self.dirty = True
+
+    def get(self, path, level, variant=""):
+        # variant: anything else the decoded tile depends on (flips, flat-field)
+        key = "{}|{}|{}".format(os.path.abspath(path), level, variant)
+        entry = self.entries.get(key)
+
+        if entry is None:
+            return None
+
+        if entry["mtime"] != os.stat(path).st_mtime_ns:
+            self._drop(key)
+            return None
+
+        # most recently used last
+        self.entries[key] = self.entries.pop(key)
+
+        view = self._get_memmap(entry["stack"])[entry["slot"]].view(np.ndarray)
+        view.flags.writeable = False
+
+        return view
+
+    def put(self, path, level, img, variant=""):
+        key = "{}|{}|{}".format(os.path.abspath(path), level, variant)
+        name = "level{}_{}".format(level, "x".join(str(x) for x in img.shape))
+
+        if key in self.entries:
+            self._drop(key)
+
+        if img.nbytes > self.max_bytes:
+            return img
+
+        self._mark_dirty()
+
+        slot = self._get_slot(name, img.shape)
+
+        if slot is None:
+            return img
+
+        stack = self._get_memmap(name)
+        stack[slot] = img
+
+        self.entries[key] = {
+            "stack": name,
+            "slot": slot,
+            "mtime": os.stat(path).st_mtime_ns
+        }
+
+        view = stack[slot].view(np.ndarray)
+        view.flags.writeable = False
+
+        return view
+
+    def _save_index(self, clean):
+        index_path = os.path.join(self.directory, INDEX_FILE)
+
+        with open(index_path + ".tmp", "w") as f:
+            json.dump({
+                "version": INDEX_VERSION,
+                "clean": clean,
+                "entries": self.entries,
+                "stacks": self.stacks
+            }, f)
+
+        os.replace(index_path + ".tmp", index_path)
+
+    def save(self):
+        for stack in self.memmaps.values():
+            stack.flush()
+
+        self._save_index(clean=True)
+        self.dirty = False
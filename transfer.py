@@ -0,0 +1,460 @@
+#!/bin/python3
+
+import logging
+import argparse
+import os
+import sys
+import json
+import time
+import hashlib
+import socket
+import socketserver
+import threading
+import queue
+
+# Streams captured tiles from the Pi to the processing machine while the scan
+# is still running. One TCP connection carries one tile after another:
+#
+#   sender   -> {"name", "size", "sha256", "meta"}\n
+#   receiver -> {"offset"}\n            bytes of this tile it already holds
+#   sender   -> raw bytes [offset:size]
+#   receiver -> {"status"}\n            "ok" or "checksum" (start over)
+#
+# Incomplete tiles are kept as partial files on the receiver, so a dropped
+# connection resumes at the last received byte. {"done": true} ends the scan.
+
+TRANSFER_PORT           = 9500
+TRANSFER_TIMEOUT        = 10.0
+TRANSFER_RETRIES        = 20
+TRANSFER_RETRY_WAIT     = 1.0
+TRANSFER_MAX_UNREACHABLE = 5        # consecutive failed connects before tiles are held back
+CHUNK_SIZE              = 64 * 1024
+
+METADATA_FILE           = "metadata.jsonl"
+
+log = logging.getLogger("transfer")
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def _send_message(sock, msg):
+    sock.sendall(bytearray(json.dumps(msg) + "\n", "utf-8"))
+
+
+def _read_message(rfile):
+    line = rfile.readline()
+
+    if len(line) == 0:
+        raise ConnectionError("connection closed by peer")
+
+    return json.loads(line.decode("utf-8"))
+
+
+class TileSender(object):
+
+    # publish() only enqueues, the actual transfer runs in a background
+    # thread so the motion loop never waits for the network
+
+    def __init__(self, host, port=TRANSFER_PORT):
+        self.host = host
+        self.port = port
+
+        self.sock = None
+        self.rfile = None
+        self.failed = []
+        self.connect_failures = 0
+        self.unreachable = False
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def publish(self, path, meta={}):
+        self.queue.put((path, meta))
+
+    def close(self):
+        # blocks until every published tile is transferred (or given up on)
+        self.queue.put(None)
+        self.thread.join()
+
+        if len(self.failed) > 0:
+            log.error("{} tiles could not be transferred, send them later with transfer.py send: {}".format(
+                len(self.failed), [path for path, meta in self.failed]))
+
+    def _connect(self):
+        try:
+            self.sock = socket.create_connection((self.host, self.port), timeout=TRANSFER_TIMEOUT)
+        except OSError:
+            # retries are per tile, without this a dead receiver would cost
+            # every remaining tile the full retry budget
+            self.connect_failures += 1
+            if not self.unreachable and self.connect_failures >= TRANSFER_MAX_UNREACHABLE:
+                log.error("receiver {}:{} unreachable, holding back tiles until it is back".format(self.host, self.port))
+                self.unreachable = True
+            raise
+
+        if self.unreachable:
+            log.info("receiver {}:{} reachable again".format(self.host, self.port))
+
+        self.connect_failures = 0
+        self.unreachable = False
+        self.rfile = self.sock.makefile("rb")
+        log.debug("connected to receiver {}:{}".format(self.host, self.port))
+
+    def _reconnect(self, attempts):
+        # True if the receiver is reachable again
+
+        for attempt in range(0, attempts):
+            try:
+                self._connect()
+                return True
+            except OSError as e:
+                log.debug("receiver still unreachable: {}".format(e))
+
+            if attempt < attempts-1:
+                time.sleep(TRANSFER_RETRY_WAIT)
+
+        return False
+
+    def _disconnect(self):
+        if self.sock is None:
+            return
+
+        try:
+            self.rfile.close()
+            self.sock.close()
+        except OSError as e:
+            log.debug("closing connection failed: {}".format(e))
+
+        self.sock = None
+        self.rfile = None
+
+    def _send_tile(self, path, meta):
+        size = os.path.getsize(path)
+        checksum = _sha256(path)
+
+        _send_message(self.sock, {
+            "name": os.path.basename(path),
+            "size": size,
+            "sha256": checksum,
+            "meta": meta
+        })
+
+        offset = _read_message(self.rfile)["offset"]
+
+        if offset > 0:
+            log.debug("resuming {} at offset {}/{}".format(os.path.basename(path), offset, size))
+
+        with open(path, "rb") as f:
+            f.seek(offset)
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                self.sock.sendall(chunk)
+
+        status = _read_message(self.rfile)["status"]
+
+        if status != "ok":
+            raise ValueError("receiver rejected {}: {}".format(os.path.basename(path), status))
+
+    def _transfer(self, path, meta):
+        # True once the receiver acknowledged the tile
+
+        for attempt in range(0, TRANSFER_RETRIES):
+            try:
+                if self.sock is None:
+                    self._connect()
+
+                self._send_tile(path, meta)
+                log.debug("transferred {}".format(os.path.basename(path)))
+                return True
+
+            except (OSError, ValueError) as e:
+                log.warning("transfer of {} failed [{}/{}]: {}".format(os.path.basename(path), attempt+1, TRANSFER_RETRIES, e))
+                self._disconnect()
+
+                if self.unreachable:
+                    return False
+
+                time.sleep(TRANSFER_RETRY_WAIT)
+
+        return False
+
+    def _send_failed(self):
+        # retry held back tiles, in capture order
+
+        failed = self.failed
+        self.failed = []
+
+        for path, meta in failed:
+            if self.unreachable or not self._transfer(path, meta):
+                self.failed.append((path, meta))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+
+            if item is None:
+                break
+
+            # while the receiver is unreachable every new tile costs a single
+            # connect attempt, tiles held back so far follow once it is back
+            if self.unreachable:
+                if not self._reconnect(1):
+                    self.failed.append(item)
+                    continue
+
+                self._send_failed()
+
+            if not self._transfer(*item):
+                self.failed.append(item)
+
+        # end of scan: one more chance for everything held back, bounded
+        # like a single tile so close() never blocks for long
+        if self.unreachable:
+            self._reconnect(TRANSFER_MAX_UNREACHABLE)
+
+        if not self.unreachable and len(self.failed) > 0:
+            self._send_failed()
+
+        if self.unreachable:
+            return
+
+        try:
+            if self.sock is None:
+                self._connect()
+            _send_message(self.sock, {"done": True})
+        except OSError as e:
+            log.warning("could not signal end of scan to receiver: {}".format(e))
+
+        self._disconnect()
+
+
+class _TileHandler(socketserver.StreamRequestHandler):
+
+    timeout = TRANSFER_TIMEOUT * 6
+
+    def handle(self):
+        try:
+            while not self.server.done:
+                line = self.rfile.readline()
+
+                if len(line) == 0:
+                    break
+
+                msg = json.loads(line.decode("utf-8"))
+
+                if msg.get("done", False):
+                    log.info("sender finished scan")
+                    self.server.done = True
+                    break
+
+                self._receive_tile(msg)
+
+        except (OSError, ValueError) as e:
+            log.warning("connection lost: {}".format(e))
+
+    def _receive_tile(self, msg):
+        name = os.path.basename(msg["name"])
+        size = msg["size"]
+
+        path = os.path.join(self.server.directory, name)
+        part = os.path.join(self.server.directory, ".{}.{}.part".format(name, msg["sha256"][:16]))
+
+        if os.path.exists(path) and _sha256(path) == msg["sha256"]:
+            # complete from an earlier attempt, the sender only missed the ack
+            self._deliver(path, msg["meta"])
+            _send_message(self.connection, {"offset": size})
+            _send_message(self.connection, {"status": "ok"})
+            return
+
+        offset = 0
+        if os.path.exists(part):
+            offset = os.path.getsize(part)
+
+        if offset > size:
+            os.remove(part)
+            offset = 0
+
+        _send_message(self.connection, {"offset": offset})
+
+        with open(part, "ab") as f:
+            remaining = size - offset
+            while remaining > 0:
+                chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+
+                if len(chunk) == 0:
+                    raise ConnectionError("connection closed during {} ({} bytes missing)".format(name, remaining))
+
+                f.write(chunk)
+                remaining -= len(chunk)
+
+        if _sha256(part) != msg["sha256"]:
+            log.warning("checksum mismatch for {}, discarding".format(name))
+            os.remove(part)
+            _send_message(self.connection, {"status": "checksum"})
+            return
+
+        os.replace(part, path)
+
+        with open(os.path.join(self.server.directory, METADATA_FILE), "a") as f:
+            f.write(json.dumps(dict(msg["meta"], name=name, sha256=msg["sha256"])) + "\n")
+
+        log.info("received {}".format(name))
+
+        # deliver before the ack, a lost ack must not lose the tile for the callback
+        self._deliver(path, msg["meta"])
+        _send_message(self.connection, {"status": "ok"})
+
+    def _deliver(self, path, meta):
+        if path in self.server.delivered:
+            return
+
+        self.server.callback(path, meta)
+        self.server.delivered.add(path)
+
+
+class TileReceiver(socketserver.TCPServer):
+
+    allow_reuse_address = True
+
+    def __init__(self, directory, callback, port=TRANSFER_PORT, host=""):
+        self.directory = directory
+        self.callback = callback
+        self.delivered = set()
+        self.done = False
+
+        socketserver.TCPServer.__init__(self, (host, port), _TileHandler)
+
+    def receive(self):
+        # serve (re)connections until the sender signals the end of the scan
+        while not self.done:
+            self.handle_request()
+
+
+def stitch_stream(receiver_queue, output_dir):
+
+    # composite tiles as they arrive. Tiles whose quality check finished late
+    # arrive at the end of their ring, after tiles captured later. Their area
+    # is repainted with all tiles in capture (file name) order, so overlaps
+    # end up as in processing.py
+
+    import cv2
+    import numpy as np
+
+    import processing
+
+    img_out = np.zeros([processing.IMAGE_SIZE[1], processing.IMAGE_SIZE[0], 3], dtype=np.uint8)
+    center = [processing.IMAGE_SIZE[0]/2, processing.IMAGE_SIZE[1]/2]
+
+    stitched = {} # name -> (f, bbox) of every tile painted so far
+
+    def overlaps(a, b):
+        return all(a[k].start < b[k].stop and b[k].start < a[k].stop for k in range(0, 2))
+
+    try:
+        while True:
+            path = receiver_queue.get()
+
+            if path is None:
+                break
+
+            # a broken tile (e.g. kept unreadable after its retakes) must not
+            # end the stream, it just stays missing in the mosaic
+            f = list(os.path.split(path))
+
+            try:
+                if all(name < f[1] for name in stitched):
+                    painted = processing.stitch_tile(img_out, f, center)
+                else:
+                    region = np.zeros_like(img_out)
+                    painted = processing.stitch_tile(region, f, center)
+
+                    if painted is not None:
+                        bbox = painted[0]
+                        region[bbox] = 0
+
+                        for name in sorted(list(stitched.keys()) + [f[1]]):
+                            other_f, other_bbox = stitched.get(name, (f, bbox))
+
+                            if other_bbox is not None and overlaps(bbox, other_bbox):
+                                processing.stitch_tile(region, other_f, center)
+
+                        img_out[bbox] = region[bbox]
+
+                stitched[f[1]] = (f, None if painted is None else painted[0])
+
+            except Exception as e:
+                log.error("could not stitch {}: {}".format(os.path.basename(path), e))
+
+    finally:
+        os.makedirs(output_dir, exist_ok=True)
+        cv2.imwrite(os.path.join(output_dir, "output.png"), img_out)
+        log.info("mosaic written to {}".format(os.path.join(output_dir, "output.png")))
+
+
+if __name__ == "__main__":
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--debug", action="store_true", default=False, help="print debug messages")
+
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    ap_receive = sub.add_parser("receive", parents=[common], help="receive tiles into a local input directory")
+    ap_receive.add_argument("directory", help="input directory for received tiles")
+    ap_receive.add_argument("--port", type=int, default=TRANSFER_PORT)
+    ap_receive.add_argument("--stitch", action="store_true", default=False, help="stitch tiles as they arrive")
+    ap_receive.add_argument("--output", default="output", help="output directory for the mosaic")
+
+    ap_send = sub.add_parser("send", parents=[common], help="send existing tiles (for testing)")
+    ap_send.add_argument("files", nargs="+")
+    ap_send.add_argument("--host", default="localhost")
+    ap_send.add_argument("--port", type=int, default=TRANSFER_PORT)
+
+    args = vars(ap.parse_args())
+
+    logging.basicConfig(
+        level=logging.DEBUG if args["debug"] else logging.INFO,
+        format="%(asctime)s | %(name)-7s | %(levelname)-7s | %(message)s")
+
+    if args["command"] == "send":
+
+        sender = TileSender(args["host"], port=args["port"])
+        for f in sorted(args["files"]):
+            sender.publish(f)
+        sender.close()
+
+        sys.exit(-1 if len(sender.failed) > 0 else 0)
+
+    elif args["command"] == "receive":
+
+        os.makedirs(args["directory"], exist_ok=True)
+
+        stitch_queue = None
+        stitch_thread = None
+
+        if args["stitch"]:
+            stitch_queue = queue.Queue()
+            stitch_thread = threading.Thread(target=stitch_stream, args=(stitch_queue, args["output"]))
+            stitch_thread.start()
+
+        def on_tile(path, meta):
+            if stitch_queue is not None:
+                stitch_queue.put(path)
+
+        with TileReceiver(args["directory"], on_tile, port=args["port"]) as receiver:
+            log.info("waiting for tiles on port {}".format(args["port"]))
+
+            try:
+                receiver.receive()
+            finally:
+                if stitch_thread is not None:
+                    stitch_queue.put(None)
+                    stitch_thread.join()